@@ -1,11 +1,39 @@
-from typing import Dict
+import time
+from typing import Dict, Optional
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from secret import read_token, save_token
 
 
+def build_session() -> requests.Session:
+    """Function to build a session that keeps connections alive between calls
+
+    Returns:
+        requests.Session: Session with a pooled, retrying https adapter
+    """
+    retries = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
 class RedditAuth:
     def __init__(self) -> None:
-        self.config = self.refresh_token()
+        self.session = build_session()
+        config = read_token()
+        # Skip the refresh round-trip while the stored access token is valid.
+        if config.get("expires_at", 0) > time.time():
+            self.config = config
+        else:
+            self.config = self.refresh_token(config)
 
     def make_request(self, config: Dict[str, str], data: Dict[str, str]) -> str:
         """Function to make request to access_token endpoint
@@ -22,7 +50,7 @@ class RedditAuth:
         """
         auth = (config["client_id"], config["client_secret"])
         headers = {"User-Agent": "Data Extraction"}
-        res = requests.post(
+        res = self.session.post(
             "https://www.reddit.com/api/v1/access_token",
             auth=auth,
             headers=headers,
@@ -30,7 +58,7 @@ class RedditAuth:
             timeout=10,
         )
         res.raise_for_status()
-        token = res.json()
+        token = orjson.loads(res.content)
         if "error" in token:
             raise requests.HTTPError(f"Error: {token['error']}")
 
@@ -41,6 +69,8 @@ class RedditAuth:
         )
         config["access_token"] = token.get(
             "access_token") or data.get("access_token")
+        # Expire a minute early so the token is not used right at its deadline.
+        config["expires_at"] = time.time() + token.get("expires_in", 0) - 60
         save_token(config)
         return config
 
@@ -52,8 +82,9 @@ class RedditAuth:
         }
         return self.make_request(data)
 
-    def refresh_token(self) -> Dict:
-        config = read_token()
+    def refresh_token(self, config: Optional[Dict] = None) -> Dict:
+        if config is None:
+            config = read_token()
         refresh_token = config["refresh_token"]
         data = {
             "grant_type": "refresh_token",
@@ -1,8 +1,15 @@
+import functools
 import textwrap
-from typing import Dict, List
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Tuple
+import orjson
 import pandas as pd
 from google.api_core.exceptions import BadRequest
 from google.cloud import bigquery
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types as storage_types
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
 import logging
 
 from static import Reddit
@@ -28,6 +35,14 @@ def schema_to_bq(schema: Dict[str, str]) -> List[bigquery.SchemaField]:
     Returns:
         List[bigquery.SchemaField]: _description_
     """
+    return list(_schema_to_bq(tuple(schema.items())))
+
+
+@functools.lru_cache(maxsize=None)
+def _schema_to_bq(
+    schema: Tuple[Tuple[str, str], ...]
+) -> Tuple[bigquery.SchemaField, ...]:
+    # Cached on the (name, dtype) pairs, since the schemas are class constants.
     type_dict = {
         "int": "INTEGER",
         "float": "FLOAT",
@@ -36,7 +51,7 @@ def schema_to_bq(schema: Dict[str, str]) -> List[bigquery.SchemaField]:
     }
     fields: List[bigquery.SchemaField] = []
 
-    for name, dtype in schema.items():
+    for name, dtype in schema:
         if dtype.endswith("!"):
             dtype = dtype[:-1]
             mode = "REQUIRED"
@@ -50,7 +65,182 @@ def schema_to_bq(schema: Dict[str, str]) -> List[bigquery.SchemaField]:
         else:
             raise ValueError(f"Field type {dtype} is not supported.")
 
-    return fields
+    return tuple(fields)
+
+
+PROTO_TYPES = {
+    "int": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+    "float": descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE,
+    # Timestamps are sent as microseconds since the epoch.
+    "timestamp": descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+    "str": descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+}
+CONVERSION_WINDOWS = (
+    "attribution_window_day",
+    "attribution_window_month",
+    "attribution_window_week",
+)
+CONVERSION_TYPES = ("click_through_conversions", "view_through_conversions")
+
+
+def schema_to_proto(schema: Dict[str, str]) -> descriptor_pb2.DescriptorProto:
+    """This function converts the source schema into a self contained
+    protobuf descriptor for the Storage Write API.
+
+    Args:
+        schema (Dict[str, str]): The source schema
+
+    Returns:
+        descriptor_pb2.DescriptorProto: Descriptor of one table row
+    """
+    field_proto = descriptor_pb2.FieldDescriptorProto
+    row = descriptor_pb2.DescriptorProto(name="RedditAdsRow")
+
+    window = row.nested_type.add(name="ConversionWindow")
+    for number, name in enumerate(CONVERSION_WINDOWS, start=1):
+        window.field.add(
+            name=name,
+            number=number,
+            type=field_proto.TYPE_INT64,
+            label=field_proto.LABEL_OPTIONAL,
+        )
+    conversion = row.nested_type.add(name="Conversion")
+    for number, name in enumerate(CONVERSION_TYPES, start=1):
+        conversion.field.add(
+            name=name,
+            number=number,
+            type=field_proto.TYPE_MESSAGE,
+            type_name=".RedditAdsRow.ConversionWindow",
+            label=field_proto.LABEL_OPTIONAL,
+        )
+
+    for number, (name, dtype) in enumerate(schema.items(), start=1):
+        if dtype.endswith("!"):
+            dtype = dtype[:-1]
+            label = field_proto.LABEL_REQUIRED
+        else:
+            label = field_proto.LABEL_OPTIONAL
+
+        if dtype in PROTO_TYPES:
+            row.field.add(
+                name=name, number=number, type=PROTO_TYPES[dtype], label=label
+            )
+        elif dtype == "conversion":
+            row.field.add(
+                name=name,
+                number=number,
+                type=field_proto.TYPE_MESSAGE,
+                type_name=".RedditAdsRow.Conversion",
+                label=label,
+            )
+        else:
+            raise ValueError(f"Field type {dtype} is not supported.")
+
+    return row
+
+
+def proto_message_class(descriptor: descriptor_pb2.DescriptorProto) -> Any:
+    pool = descriptor_pool.DescriptorPool()
+    file_proto = descriptor_pb2.FileDescriptorProto(
+        name="reddit_ads_row.proto", syntax="proto2"
+    )
+    file_proto.message_type.add().CopyFrom(descriptor)
+    pool.Add(file_proto)
+    message = pool.FindMessageTypeByName(descriptor.name)
+    # GetMessageClass replaces MessageFactory.GetPrototype in newer protobuf.
+    if hasattr(message_factory, "GetMessageClass"):
+        return message_factory.GetMessageClass(message)
+    return message_factory.MessageFactory(pool).GetPrototype(message)
+
+
+def set_proto_value(message: Any, name: str, dtype: str, value: Any) -> None:
+    if dtype == "conversion":
+        # Mark the records as present even when none of their fields are set.
+        nested = getattr(message, name)
+        nested.SetInParent()
+        for conversion_type in CONVERSION_TYPES:
+            windows = value.get(conversion_type)
+            if not isinstance(windows, dict):
+                continue
+            target = getattr(nested, conversion_type)
+            target.SetInParent()
+            for window in CONVERSION_WINDOWS:
+                if windows.get(window) is not None:
+                    setattr(target, window, int(windows[window]))
+    elif dtype == "timestamp":
+        setattr(message, name, pd.Timestamp(value).value // 1000)
+    elif dtype == "int":
+        setattr(message, name, int(value))
+    elif dtype == "float":
+        setattr(message, name, float(value))
+    else:
+        setattr(message, name, str(value))
+
+
+PARAMETER_TYPES = {
+    "int": "INT64",
+    "float": "FLOAT64",
+    "timestamp": "TIMESTAMP",
+    "str": "STRING",
+    # Conversion records are passed as JSON and rebuilt in the query.
+    "conversion": "STRING",
+}
+
+
+def parameter_value(dtype: str, value: Any) -> Any:
+    if dtype == "conversion":
+        if not isinstance(value, dict):
+            return None
+        return orjson.dumps(value).decode("utf-8")
+    if pd.isna(value):
+        return None
+    if dtype == "int":
+        return int(value)
+    if dtype == "float":
+        return float(value)
+    if dtype == "timestamp":
+        return pd.Timestamp(value).to_pydatetime()
+    return str(value)
+
+
+def conversion_from_json(name: str) -> str:
+    """This function builds the SQL expression turning the JSON
+    parameter of a conversion column back into its record, keeping
+    missing records and sub records as null.
+
+    Args:
+        name (str): The name of the conversion column
+
+    Returns:
+        str: SQL expression for the column
+    """
+    records = []
+    for conversion_type in CONVERSION_TYPES:
+        path = f"$.{conversion_type}"
+        windows = ", ".join(
+            f"cast(json_value(r.{name}, '{path}.{w}') as int64) as {w}"
+            for w in CONVERSION_WINDOWS
+        )
+        records.append(
+            f"if(ifnull(json_query(r.{name}, '{path}'), 'null') = 'null', null, "
+            f"struct({windows})) as {conversion_type}"
+        )
+    return f"if(r.{name} is null, null, struct({', '.join(records)})) as {name}"
+
+
+@functools.lru_cache(maxsize=4)
+def _get_client(project_id: str, priority: str) -> bigquery.Client:
+    # Building a client loads credentials and opens a channel, so warm
+    # processes share one client per project and query priority.
+    return bigquery.Client(
+        project=project_id,
+        default_query_job_config=bigquery.QueryJobConfig(priority=priority),
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _get_write_client() -> bigquery_storage_v1.BigQueryWriteClient:
+    return bigquery_storage_v1.BigQueryWriteClient()
 
 
 class BigQueryDatabase:
@@ -92,14 +282,28 @@ class BigQueryDatabase:
         campaign_name="str",
     )
 
-    def __init__(self, project_id: str):
+    # Subset of the merge keys the tables are clustered on.
+    CLUSTERING_FIELDS = ["ad_id", "campaign_id", "ad_group_id"]
+    STRATEGIES = ("merge", "replace")
+    LOAD_MODES = ("stream", "job")
+    # BigQuery drops tmp tables by itself once this has passed.
+    TMP_TABLE_TTL = timedelta(hours=2)
+    # Rows per AppendRowsRequest, kept well under the 10MB request limit.
+    APPEND_ROWS_BATCH = 10_000
+    # Below this many rows a single DML insert is cheaper than a load.
+    DML_INSERT_MAX_ROWS = 500
+
+    def __init__(
+        self, project_id: str, strategy: str = "merge", load_mode: str = "stream"
+    ):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Strategy {strategy} is not supported.")
+        if load_mode not in self.LOAD_MODES:
+            raise ValueError(f"Load mode {load_mode} is not supported.")
         self.project_id = project_id
-        self.client = bigquery.Client(
-            project=project_id,
-            default_query_job_config=bigquery.QueryJobConfig(
-                priority=bigquery.QueryPriority.BATCH
-            ),
-        )
+        self.strategy = strategy
+        self.load_mode = load_mode
+        self.client = _get_client(project_id, bigquery.QueryPriority.BATCH)
 
     def ensure_table(self, schema: Dict[str, str], table_id: str) -> None:
         """
@@ -113,6 +317,10 @@ class BigQueryDatabase:
 
         """
         table = bigquery.Table(table_id, schema=schema_to_bq(schema))
+        table.time_partitioning = bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY, field="date"
+        )
+        table.clustering_fields = self.CLUSTERING_FIELDS
         self.client.create_table(table, exists_ok=True)
 
     def save_table(self, table: pd.DataFrame) -> None:
@@ -122,28 +330,82 @@ class BigQueryDatabase:
         Args:
             table (pd.DataFrame): The dataframe with table's data.
         """
-        tmp_table_id = f"{self.project_id}.{Reddit.DATASET}.{Reddit.TMP_TABLE}"
+        if len(table) == 0:
+            logging.info("No rows to merge")
+            return
+
+        # Each run gets its own tmp table, which expires instead of being deleted.
+        tmp_table_name = f"{Reddit.TMP_TABLE}_{uuid.uuid4().hex[:8]}"
+        tmp_table_id = f"{self.project_id}.{Reddit.DATASET}.{tmp_table_name}"
         self.save_new_table(table, tmp_table_id)
 
-        try:
+        if self.strategy == "merge":
             self.merge_tables(tmp_table_id)
-        finally:
-            self.client.delete_table(tmp_table_id)
+        else:
+            dates = [
+                date.to_pydatetime() for date in table["date"].dropna().unique()
+            ]
+            self.replace_partitions(tmp_table_id, dates)
 
-    def merge_tables(self, tmp_table_id: str) -> None:
+    def replace_partitions(self, tmp_table_id: str, dates: List[datetime]) -> None:
         """
-        This function merges the tmp table with
-        the destination table.
+        This function replaces the given dates in the destination table
+        with the records of the tmp table. The dates are passed as a
+        query parameter, so the delete only scans their partitions.
 
         Args:
             tmp_table_id (str): the name of temporary table.
+            dates (List[datetime]): the dates present in the tmp table.
         """
         table_id = f"{self.project_id}.{Reddit.DATASET}.{Reddit.TABLE}"
         self.ensure_table(self.REDDITADS_SCHEMA, table_id)
 
-        insert_cols_list = set(self.REDDITADS_SCHEMA.keys())
-        keys = {"date", "ad_id", "ad_group_id", "account_id", "campaign_id"}
-        update_cols_list = insert_cols_list - keys
+        cols = ",\n".join(self.REDDITADS_SCHEMA.keys())
+
+        def indent(text: str) -> str:
+            return textwrap.indent(text, " " * 8)
+
+        query = f"""
+        begin transaction;
+
+        delete from {table_id}
+        where date in unnest(@dates);
+
+        insert {table_id} (
+            {indent(cols)}
+        )
+        select
+            {indent(cols)}
+        from {tmp_table_id};
+
+        commit transaction;
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ArrayQueryParameter("dates", "TIMESTAMP", dates)
+            ]
+        )
+        job = self.client.query(query, job_config=job_config)
+        try:
+            job.result()
+            logging.info("Replaced dates with records from %s", tmp_table_id)
+        except BadRequest as exc:
+            raise ValueError(job.errors) from exc
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _merge_sql_template(cls) -> str:
+        """
+        This function builds the merge query once, with {table_id}
+        and {tmp_table_id} left as format placeholders. Columns keep
+        the schema order so every run sends the same query text.
+
+        Returns:
+            str: the merge query template.
+        """
+        insert_cols_list = list(cls.REDDITADS_SCHEMA.keys())
+        keys = ["date", "ad_id", "ad_group_id", "account_id", "campaign_id"]
+        update_cols_list = [c for c in insert_cols_list if c not in keys]
 
         update_cols = ",\n".join(f"{c} = tmp.{c}" for c in update_cols_list)
         insert_cols = ",\n".join(insert_cols_list)
@@ -153,9 +415,9 @@ class BigQueryDatabase:
         def indent(text: str) -> str:
             return textwrap.indent(text, " " * 8)
 
-        query = f"""
-        merge {table_id} as old
-        using {tmp_table_id} as tmp
+        return f"""
+        merge {{table_id}} as old
+        using {{tmp_table_id}} as tmp
             on {indent(join_cols)}
         when matched then
             update set
@@ -168,6 +430,21 @@ class BigQueryDatabase:
                 {indent(value_cols)}
             )
         """
+
+    def merge_tables(self, tmp_table_id: str) -> None:
+        """
+        This function merges the tmp table with
+        the destination table.
+
+        Args:
+            tmp_table_id (str): the name of temporary table.
+        """
+        table_id = f"{self.project_id}.{Reddit.DATASET}.{Reddit.TABLE}"
+        self.ensure_table(self.REDDITADS_SCHEMA, table_id)
+
+        query = self._merge_sql_template().format(
+            table_id=table_id, tmp_table_id=tmp_table_id
+        )
         job = self.client.query(query)
         try:
             job_result = job.result()
@@ -176,14 +453,110 @@ class BigQueryDatabase:
             raise ValueError(job.errors) from exc
 
     def save_new_table(self, table: pd.DataFrame, table_id: str) -> str:
+        table = table[self.REDDITADS_SCHEMA.keys()]
+        tmp_table = bigquery.Table(table_id, schema=schema_to_bq(self.REDDITADS_SCHEMA))
+        tmp_table.clustering_fields = self.CLUSTERING_FIELDS
+        tmp_table.expires = datetime.now(timezone.utc) + self.TMP_TABLE_TTL
+        self.client.create_table(tmp_table)
+
+        if 0 < len(table) < self.DML_INSERT_MAX_ROWS:
+            return self.insert_new_table(table, table_id)
+        if self.load_mode == "job":
+            return self.load_new_table(table, table_id)
+        return self.stream_new_table(table, table_id)
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _insert_sql_template(cls) -> str:
+        """
+        This function builds the insert query once, with {tmp_table_id}
+        left as a format placeholder. Rows come in as the @rows array
+        of structs.
+
+        Returns:
+            str: the insert query template.
+        """
+        insert_cols = ",\n".join(cls.REDDITADS_SCHEMA.keys())
+        select_cols = ",\n".join(
+            conversion_from_json(c) if dtype.rstrip("!") == "conversion" else f"r.{c}"
+            for c, dtype in cls.REDDITADS_SCHEMA.items()
+        )
+
+        def indent(text: str) -> str:
+            return textwrap.indent(text, " " * 8)
+
+        return f"""
+        insert {{tmp_table_id}} (
+            {indent(insert_cols)}
+        )
+        select
+            {indent(select_cols)}
+        from unnest(@rows) as r
+        """
+
+    def insert_new_table(self, table: pd.DataFrame, table_id: str) -> str:
+        """
+        Function to write a small batch of rows into the tmp table with
+        one parameterized DML insert, skipping the load job.
+
+        Args:
+            table (pd.DataFrame): The dataframe with table's data.
+            table_id (str): The name of the tmp table.
+
+        Returns:
+            str: The name of the tmp table.
+        """
+        rows = [
+            bigquery.StructQueryParameter(
+                None,
+                *(
+                    bigquery.ScalarQueryParameter(
+                        name,
+                        PARAMETER_TYPES[dtype.rstrip("!")],
+                        parameter_value(dtype.rstrip("!"), record[name]),
+                    )
+                    for name, dtype in self.REDDITADS_SCHEMA.items()
+                ),
+            )
+            for record in table.to_dict("records")
+        ]
+        # Run interactively, since a batch query can sit in the queue longer
+        # than the load job this replaces.
+        job_config = bigquery.QueryJobConfig(
+            priority=bigquery.QueryPriority.INTERACTIVE,
+            query_parameters=[bigquery.ArrayQueryParameter("rows", "STRUCT", rows)],
+        )
+        query = self._insert_sql_template().format(tmp_table_id=table_id)
+        job = self.client.query(query, job_config=job_config)
+        try:
+            job.result()
+            logging.info("Inserted %s new records in tmp table", len(table))
+        except BadRequest as exc:
+            raise ValueError(job.errors) from exc
+
+        return table_id
+
+    def load_new_table(self, table: pd.DataFrame, table_id: str) -> str:
+        """
+        Function to write the rows into the tmp table with a Parquet load job.
+
+        Args:
+            table (pd.DataFrame): The dataframe with table's data.
+            table_id (str): The name of the tmp table.
+
+        Returns:
+            str: The name of the tmp table.
+        """
         job_config = bigquery.LoadJobConfig(
             schema=schema_to_bq(self.REDDITADS_SCHEMA),
             source_format=bigquery.SourceFormat.PARQUET,
-            write_disposition="WRITE_TRUNCATE",
+            write_disposition="WRITE_APPEND",
+            clustering_fields=self.CLUSTERING_FIELDS,
         )
-        table = table[self.REDDITADS_SCHEMA.keys()]
+        # The explicit schema makes the client write INTEGER and FLOAT columns
+        # as 64 bit Parquet columns, so shrink the upload with compression.
         job = self.client.load_table_from_dataframe(
-            table, table_id, job_config=job_config
+            table, table_id, job_config=job_config, parquet_compression="ZSTD"
         )
         try:
             job.result()
@@ -192,3 +565,58 @@ class BigQueryDatabase:
             raise ValueError(job.errors) from exc
 
         return table_id
+
+    def stream_new_table(self, table: pd.DataFrame, table_id: str) -> str:
+        """
+        Function to write the rows into the tmp table through the default
+        stream of the Storage Write API, skipping the load job.
+
+        Args:
+            table (pd.DataFrame): The dataframe with table's data.
+            table_id (str): The name of the tmp table.
+
+        Returns:
+            str: The name of the tmp table.
+        """
+        project, dataset, name = table_id.split(".")
+        write_client = _get_write_client()
+        stream = f"{write_client.table_path(project, dataset, name)}/streams/_default"
+        # The generated streaming method does not add the routing header the
+        # service needs to route the bidi stream to the table.
+        responses = write_client.append_rows(
+            self.append_rows_requests(table, stream),
+            metadata=(("x-goog-request-params", f"write_stream={stream}"),),
+        )
+        for response in responses:
+            if response.error.code:
+                raise ValueError(response.error.message)
+            if response.row_errors:
+                raise ValueError([error.message for error in response.row_errors])
+
+        logging.info("Streamed %s new records in tmp table", len(table))
+        return table_id
+
+    def append_rows_requests(
+        self, table: pd.DataFrame, stream: str
+    ) -> Iterator[storage_types.AppendRowsRequest]:
+        descriptor = schema_to_proto(self.REDDITADS_SCHEMA)
+        row_class = proto_message_class(descriptor)
+        writer_schema = storage_types.ProtoSchema(proto_descriptor=descriptor)
+
+        records = table.to_dict("records")
+        for start in range(0, len(records), self.APPEND_ROWS_BATCH):
+            rows = storage_types.ProtoRows()
+            for record in records[start:start + self.APPEND_ROWS_BATCH]:
+                row = row_class()
+                for name, dtype in self.REDDITADS_SCHEMA.items():
+                    value = record[name]
+                    if isinstance(value, dict) or not pd.isna(value):
+                        set_proto_value(row, name, dtype.rstrip("!"), value)
+                rows.serialized_rows.append(row.SerializeToString())
+
+            yield storage_types.AppendRowsRequest(
+                write_stream=stream,
+                proto_rows=storage_types.AppendRowsRequest.ProtoData(
+                    writer_schema=writer_schema, rows=rows
+                ),
+            )
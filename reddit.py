@@ -1,23 +1,44 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Any, Dict, List, Optional
 
 import click
+import orjson
 import pandas as pd
-import requests
 from requests.exceptions import HTTPError
 from ratelimit import limits, sleep_and_retry
-from auth import RedditAuth
+from auth import RedditAuth, build_session
 from database import BigQueryDatabase
 
 from static import Reddit
 
 logging.basicConfig(level=logging.INFO)
 
+# Report columns to keep. Ids and names of the ads, ad groups and campaigns
+# are joined in from their own endpoints.
+LOOKUP_COLUMNS = {
+    "ad_group_id",
+    "campaign_id",
+    "account_id",
+    "ad_name",
+    "ad_group_name",
+    "campaign_name",
+}
+REPORT_COLUMNS = [
+    c for c in BigQueryDatabase.REDDITADS_SCHEMA if c not in LOOKUP_COLUMNS
+]
+CONVERSION_COLUMNS = [
+    c
+    for c in REPORT_COLUMNS
+    if BigQueryDatabase.REDDITADS_SCHEMA[c].rstrip("!") == "conversion"
+]
+
 
 class RedditApi:
     def __init__(self) -> None:
         self.base = "https://ads-api.reddit.com/api/v2.0"
+        self.session = build_session()
         auth = RedditAuth()
         config = auth.config
         self.account_id = config["account_id"]
@@ -35,11 +56,12 @@ class RedditApi:
         params: Optional[Dict[str, Any]] = None,
     ) -> Any:
         url = f"{self.base}/accounts/{self.account_id}/{resource}"
-        res = requests.get(
+        res = self.session.get(
             url, params=params, data=data, headers=self.headers, timeout=10
         )
         res.raise_for_status()
-        payload = res.json()
+        # Decode the UTF-8 body directly instead of going through res.text.
+        payload = orjson.loads(res.content)
 
         return payload["data"]
 
@@ -83,68 +105,89 @@ class RedditApi:
 
 
 def transform_report(report: List[Dict[str, Any]]) -> pd.DataFrame:
-    dataframe = (
-        pd.DataFrame(report)
-        .drop(columns=["ad_group_id", "campaign_id", "account_id"])
-        .dropna(axis="columns", how="all")
+    # Every schema column is kept, even when empty, since the tmp table
+    # upload selects all of them.
+    dataframe = pd.DataFrame.from_records(report, columns=REPORT_COLUMNS)
+    # A conversion missing from every row comes out as a float NaN column,
+    # which the Parquet load cannot turn into a RECORD. Use None instead.
+    conversions = dataframe[CONVERSION_COLUMNS].astype(object)
+    dataframe[CONVERSION_COLUMNS] = conversions.where(conversions.notna(), None)
+    # Report dates share one fixed format, so skip per-row format inference.
+    dataframe["date"] = pd.to_datetime(
+        dataframe["date"], format=Reddit.BQ_DATE_FORMAT, utc=True, cache=True
     )
-    dataframe["date"] = pd.to_datetime(dataframe.date)
     return dataframe
 
 
 def transform_ads(ads: List[Dict[str, Any]]) -> pd.DataFrame:
-    dataframe = pd.DataFrame(ads)[
-        [
+    dataframe = pd.DataFrame.from_records(
+        ads,
+        columns=[
             "id",
             "ad_group_id",
             "name",
-        ]
-    ]
+        ],
+    )
     dataframe = dataframe.rename(columns={"id": "ad_id", "name": "ad_name"})
     return dataframe
 
 
 def transform_ad_groups(ad_groups: List[Dict[str, Any]]) -> pd.DataFrame:
-    dataframe = pd.DataFrame(ad_groups)[
-        [
+    dataframe = pd.DataFrame.from_records(
+        ad_groups,
+        columns=[
             "id",
             "account_id",
             "campaign_id",
             "name",
-        ]
-    ]
+        ],
+    )
     dataframe = dataframe.rename(
         columns={"id": "ad_group_id", "name": "ad_group_name"})
     return dataframe
 
 
 def transform_campagins(campaigns: List[Dict[str, Any]]) -> pd.DataFrame:
-    dataframe = pd.DataFrame(campaigns)[
-        [
+    dataframe = pd.DataFrame.from_records(
+        campaigns,
+        columns=[
             "id",
             "name",
-        ]
-    ]
+        ],
+    )
     dataframe = dataframe.rename(
         columns={"id": "campaign_id", "name": "campaign_name"})
     return dataframe
 
 
 def get_result(api: RedditApi, start_date: datetime) -> pd.DataFrame:
-    report = api.get_reports(start_date)
-    ads = api.get_ads()
-    ad_groups = api.get_ad_groups()
-    campaigns = api.get_campaigns()
-
-    report_df = transform_report(report)
-    ads_df = transform_ads(ads)
-    ad_groups_df = transform_ad_groups(ad_groups)
-    campaigns_df = transform_campagins(campaigns)
-
-    result = pd.merge(report_df, ads_df, on="ad_id")
-    result = pd.merge(result, ad_groups_df, on="ad_group_id")
-    result = pd.merge(result, campaigns_df, on="campaign_id")
-    result = result.sort_values("date")
+    # The endpoints are independent, so fetch them concurrently. The rate limit
+    # on make_request still spaces out request starts. Each worker transforms
+    # its own payload, so the report transform overlaps the remaining fetches.
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        report_future = executor.submit(
+            lambda: transform_report(api.get_reports(start_date))
+        )
+        ads_future = executor.submit(lambda: transform_ads(api.get_ads()))
+        ad_groups_future = executor.submit(
+            lambda: transform_ad_groups(api.get_ad_groups())
+        )
+        campaigns_future = executor.submit(
+            lambda: transform_campagins(api.get_campaigns())
+        )
+
+        report_df = report_future.result()
+        ads_df = ads_future.result()
+        ad_groups_df = ad_groups_future.result()
+        campaigns_df = campaigns_future.result()
+
+    # The lookup frames are small, so index them once and probe per report row.
+    result = (
+        report_df.join(ads_df.set_index("ad_id"), on="ad_id", how="inner")
+        .join(ad_groups_df.set_index("ad_group_id"), on="ad_group_id", how="inner")
+        .join(campaigns_df.set_index("campaign_id"), on="campaign_id", how="inner")
+    )
+    result = result.sort_values("date", kind="stable")
     return result
 
 
@@ -156,8 +199,26 @@ def get_result(api: RedditApi, start_date: datetime) -> pd.DataFrame:
     show_default=True,
 )
 @click.option("--project_id", default="", type=str)
-def main(project_id: str, start_date: datetime) -> None:
-    db = BigQueryDatabase(project_id=project_id)
+@click.option(
+    "--strategy",
+    default="merge",
+    type=click.Choice(BigQueryDatabase.STRATEGIES),
+    show_default=True,
+)
+@click.option(
+    "--load-mode",
+    default="stream",
+    type=click.Choice(BigQueryDatabase.LOAD_MODES),
+    show_default=True,
+    help=(
+        "How rows reach the tmp table. Reports under "
+        f"{BigQueryDatabase.DML_INSERT_MAX_ROWS} rows always use a single insert."
+    ),
+)
+def main(project_id: str, start_date: datetime, strategy: str, load_mode: str) -> None:
+    db = BigQueryDatabase(
+        project_id=project_id, strategy=strategy, load_mode=load_mode
+    )
     api = RedditApi()
 
     try:
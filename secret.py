@@ -1,23 +1,28 @@
 from typing import Optional
-import json
+import functools
 import logging
+import orjson
 from google.cloud import secretmanager
 from static import Reddit
 
 
+@functools.lru_cache(maxsize=1)
+def _client() -> secretmanager.SecretManagerServiceClient:
+    return secretmanager.SecretManagerServiceClient()
+
+
 def read_token() -> Optional[dict]:
     """read_token fetchs the token value.
 
     Returns:
         Optional[dict]: token dictionary
     """
-    client = secretmanager.SecretManagerServiceClient()
+    client = _client()
     secret_detail = (
         f"projects/{Reddit.PROJECT_ID}/secrets/{Reddit.SECRET_STRING}/versions/latest"
     )
     response = client.access_secret_version(name=secret_detail)
-    data = response.payload.data.decode("utf-8")
-    config = json.loads(data)
+    config = orjson.loads(response.payload.data)
     return config
 
 
@@ -30,10 +35,9 @@ def save_token(config: Optional[dict] = None) -> dict:
     Returns:
         dict: token data
     """
-    client = secretmanager.SecretManagerServiceClient()
+    client = _client()
     parent = client.secret_path(Reddit.PROJECT_ID, Reddit.SECRET_STRING)
-    config = json.dumps(config, indent=4, separators=(
-        ",", ": ")).encode("utf-8")
+    config = orjson.dumps(config, option=orjson.OPT_INDENT_2)
     response = client.add_secret_version(
         request={
             "parent": parent,
@@ -1,11 +1,15 @@
-from enum import Enum
+from dataclasses import dataclass
 
 
-class Reddit(str, Enum):
-    PROJECT_ID = "702739857141"
-    SECRET_STRING = "reddit_secret"
-    DATASET = "reddit"
-    TABLE = "redditads"
-    TMP_TABLE = "redditads_tmp"
-    BQ_DATE_FORMAT = "%Y-%m-%dT00:00:00Z"
-    DEFAULT_START_DATE = "2021-03-01"
+@dataclass(frozen=True)
+class _Reddit:
+    PROJECT_ID: str = "702739857141"
+    SECRET_STRING: str = "reddit_secret"
+    DATASET: str = "reddit"
+    TABLE: str = "redditads"
+    TMP_TABLE: str = "redditads_tmp"
+    BQ_DATE_FORMAT: str = "%Y-%m-%dT00:00:00Z"
+    DEFAULT_START_DATE: str = "2021-03-01"
+
+
+Reddit = _Reddit()
@@ -0,0 +1,132 @@
+import math
+
+import pandas as pd
+from google.protobuf import descriptor_pb2
+
+from database import (
+    BigQueryDatabase,
+    proto_message_class,
+    schema_to_proto,
+    set_proto_value,
+)
+
+FIELD = descriptor_pb2.FieldDescriptorProto
+SCHEMA = dict(
+    spend="int!",
+    ctr="float",
+    date="timestamp",
+    ad_id="str",
+    purchase="conversion",
+)
+
+
+def test_schema_to_proto_fields():
+    descriptor = schema_to_proto(SCHEMA)
+    fields = {field.name: field for field in descriptor.field}
+
+    assert list(fields) == list(SCHEMA)
+    assert [field.number for field in descriptor.field] == [1, 2, 3, 4, 5]
+    assert fields["spend"].type == FIELD.TYPE_INT64
+    assert fields["spend"].label == FIELD.LABEL_REQUIRED
+    assert fields["ctr"].type == FIELD.TYPE_DOUBLE
+    assert fields["ctr"].label == FIELD.LABEL_OPTIONAL
+    assert fields["date"].type == FIELD.TYPE_INT64
+    assert fields["ad_id"].type == FIELD.TYPE_STRING
+    assert fields["purchase"].type == FIELD.TYPE_MESSAGE
+    assert fields["purchase"].type_name == ".RedditAdsRow.Conversion"
+    assert [nested.name for nested in descriptor.nested_type] == [
+        "ConversionWindow",
+        "Conversion",
+    ]
+
+
+def test_schema_to_proto_unsupported_type():
+    try:
+        schema_to_proto(dict(spend="decimal"))
+    except ValueError as exc:
+        assert "decimal" in str(exc)
+    else:
+        raise AssertionError("ValueError not raised")
+
+
+def test_set_proto_value():
+    row = proto_message_class(schema_to_proto(SCHEMA))()
+    set_proto_value(row, "spend", "int", 12)
+    set_proto_value(row, "ctr", "float", 0.25)
+    set_proto_value(row, "date", "timestamp", pd.Timestamp("2021-03-01", tz="UTC"))
+    set_proto_value(row, "ad_id", "str", "t3_abc")
+    set_proto_value(
+        row,
+        "purchase",
+        "conversion",
+        {"click_through_conversions": {"attribution_window_day": 3}},
+    )
+
+    assert row.spend == 12
+    assert row.ctr == 0.25
+    assert row.date == 1614556800000000
+    assert row.ad_id == "t3_abc"
+    assert row.purchase.click_through_conversions.attribution_window_day == 3
+    assert not row.purchase.click_through_conversions.HasField(
+        "attribution_window_week"
+    )
+    assert not row.purchase.HasField("view_through_conversions")
+
+
+def test_append_rows_requests():
+    db = BigQueryDatabase.__new__(BigQueryDatabase)
+    db.REDDITADS_SCHEMA = SCHEMA
+    db.APPEND_ROWS_BATCH = 2
+    table = pd.DataFrame(
+        {
+            "spend": [1, 2, 3],
+            "ctr": [0.5, math.nan, 1.5],
+            "date": pd.to_datetime(["2021-03-01"] * 3, utc=True),
+            "ad_id": ["a", "b", None],
+            "purchase": [{}, math.nan, {"view_through_conversions": {}}],
+        }
+    )
+    stream = "projects/p/datasets/d/tables/t/streams/_default"
+
+    requests = list(db.append_rows_requests(table, stream))
+
+    assert [len(r.proto_rows.rows.serialized_rows) for r in requests] == [2, 1]
+    assert all(r.write_stream == stream for r in requests)
+    row_class = proto_message_class(
+        requests[0].proto_rows.writer_schema.proto_descriptor
+    )
+    rows = [
+        row_class.FromString(serialized)
+        for r in requests
+        for serialized in r.proto_rows.rows.serialized_rows
+    ]
+    assert [row.spend for row in rows] == [1, 2, 3]
+    assert rows[0].HasField("purchase")
+    assert not rows[0].purchase.HasField("click_through_conversions")
+    assert not rows[1].HasField("ctr")
+    assert not rows[1].HasField("purchase")
+    assert not rows[2].HasField("ad_id")
+    assert rows[2].purchase.HasField("view_through_conversions")
+
+
+def test_transform_report_missing_conversion():
+    from google.cloud.bigquery import _pandas_helpers
+
+    from database import conversion_field
+    from reddit import transform_report
+
+    purchase = {"click_through_conversions": {"attribution_window_day": 1}}
+    report = [
+        {"date": "2021-03-01T00:00:00Z", "ad_id": "a", "purchase": purchase},
+        {"date": "2021-03-02T00:00:00Z", "ad_id": "b"},
+    ]
+
+    dataframe = transform_report(report)
+
+    assert dataframe["add_to_wishlist"].dtype == object
+    assert dataframe["add_to_wishlist"].tolist() == [None, None]
+    assert dataframe["purchase"].tolist() == [purchase, None]
+    array = _pandas_helpers.bq_to_arrow_array(
+        dataframe["add_to_wishlist"], conversion_field("add_to_wishlist")
+    )
+    assert array.null_count == 2